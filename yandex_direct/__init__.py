@@ -1 +1 @@
-__all__ = ['ydbase', 'ycmpg']
+__all__ = ['ydbase', 'ycmpg', 'yv4jobs', 'ybids']
@@ -0,0 +1,178 @@
+from common_constants import constants
+from yandex_direct import ydbase
+from concurrent.futures import ThreadPoolExecutor
+ENVI = constants.EnviVar(
+    main_dir="/home/eugene/Yandex.Disk/localsource/yandex_direct/",
+    cred_dir="/home/eugene/Yandex.Disk/localsource/credentials/"
+)
+logger = constants.logging.getLogger(__name__)
+
+
+class BidRules:
+    """
+    Правила расчета ставок на поиске. Все денежные величины в микроединицах валюты (как Cost в отчетах и Bid в API).
+
+    Ставка считается сразу для всех критериев по колонкам статистики:
+    target_cpa - ставка = target_cpa * Conversions / Clicks (при Clicks >= min_clicks, иначе текущая ставка),
+    target_cpc - ставка = target_cpc (если target_cpa не задан или данных недостаточно),
+    top_position - если средняя позиция показа уже не хуже top_position, ставка не повышается.
+    Рассчитанная правилом ставка округляется до step и ограничивается [min_bid, max_bid],
+    если ни одно правило не применимо, текущая ставка возвращается без изменений.
+    """
+    def __init__(self, target_cpa=None, target_cpc=None, min_bid=300000, max_bid=50000000,
+                 min_clicks=10, top_position=None, step=100000):
+        self.target_cpa = target_cpa
+        self.target_cpc = target_cpc
+        self.min_bid = min_bid
+        self.max_bid = max_bid
+        self.min_clicks = min_clicks
+        self.top_position = top_position
+        self.step = step
+
+    def compute(self, current: dict, stat: dict) -> dict:
+        """
+        :param current: dict KeywordId -> текущая ставка
+        :param stat: dict CriteriaId -> статистика (см. TSVReportByDate.criteria_stat)
+        :return: dict KeywordId -> новая ставка
+        """
+        empty = {"Clicks": 0, "Conversions": 0, "AvgImpressionPosition": None}
+        ids = list(current)
+        bids = [current[i] for i in ids]
+        rows = [stat.get(i, empty) for i in ids]
+        clicks = [i['Clicks'] for i in rows]
+        conversions = [i['Conversions'] for i in rows]
+        positions = [i['AvgImpressionPosition'] for i in rows]
+
+        target = [None] * len(ids)  # None - ни одно правило не применимо
+        if self.target_cpc is not None:
+            target = [self.target_cpc] * len(ids)
+        if self.target_cpa is not None:
+            target = [self.target_cpa * cv / cl if cl >= self.min_clicks else t
+                      for t, cv, cl in zip(target, conversions, clicks)]
+
+        step, low, high = self.step, self.min_bid, self.max_bid
+        target = [None if t is None else min(max(int(round(t / step)) * step, low), high) for t in target]
+        if self.top_position is not None:
+            target = [min(t, b) if t is not None and p is not None and p <= self.top_position else t
+                      for t, b, p in zip(target, bids, positions)]
+        return {i: b if t is None else t for i, b, t in zip(ids, bids, target)}
+
+
+class YKeywordBids(ydbase.YandexDirectBase):
+    set_limit = 10000  # максимальное количество ставок в одном вызове KeywordBids.set
+    max_workers = 5  # не более 5 одновременных запросов к API от одного пользователя
+
+    def __init__(self, campaign_ids, directory=None, dump_file_prefix="ybids", cache=False, account="default", login="default"):
+        if directory is None:
+            directory = f"{ENVI['MAIN_PYSEA_DIR']}alldata/cache"
+        super(YKeywordBids, self).__init__(directory=directory, dump_file_prefix=dump_file_prefix, cache=cache, account=account, login=login)
+
+        self.campaign_ids = campaign_ids
+        self.data = self.__get_bids(campaign_ids)
+        self.bids = {i['KeywordId']: i['Search']['Bid'] for i in self.data if i.get('Search')}
+        self.errors = []
+
+    def __str__(self):
+        return f"<<Ставки Яндекс Директ {len(self.bids)} для кампаний {self.campaign_ids}>>"
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.data)
+
+    @ydbase.dump_to("bids")
+    @ydbase.main_array_limit(10)
+    @ydbase.limit_by(10000)
+    def __get_bids(self, campaign_ids):
+        """
+        Реализует метод API:
+        https://yandex.ru/dev/direct/doc/ref-v5/keywordbids/get.html
+
+        :return:
+        """
+
+        # Создание тела запроса
+        body = {"method": 'get',
+                "params":  {
+                            "SelectionCriteria": {
+                                "CampaignIds": campaign_ids,
+                            },
+                            "FieldNames": ["KeywordId", "AdGroupId", "CampaignId"],
+                            "SearchFieldNames": ["Bid"],
+                            "Page": {"Limit": self.limit_by, "Offset": self.offset}
+                           }
+                }
+
+        result = self.send_request(body, "KeywordBids")
+        if not result.json()['result']:
+            return {}, False
+        return result.json()['result']['KeywordBids'], result.json()['result'].get('LimitedBy', False)
+
+    def compute(self, report: ydbase.TSVReportByDate, rules: BidRules, from_date=False, to_date=False) -> dict:
+        """
+        Рассчитывает ставки для всех ключевых фраз по статистике отчета
+
+        :param report: отчет со статистикой по критериям (CriteriaId == KeywordId)
+        :param rules: правила расчета ставок
+        :param from_date: дата в формате YYYY-MM-DD или class 'datetime.date'
+        :param to_date: дата в формате YYYY-MM-DD или class 'datetime.date'
+        :return: dict KeywordId -> новая ставка
+        """
+        return rules.compute(self.bids, report.criteria_stat(from_date, to_date))
+
+    def diff(self, new_bids: dict) -> list:
+        """
+        :param new_bids: dict KeywordId -> новая ставка
+        :return: список изменений [{"KeywordId", "Bid", "NewBid"}] только для ставок, которые отличаются от текущих
+        """
+        return [{"KeywordId": i, "Bid": self.bids.get(i), "NewBid": bid}
+                for i, bid in new_bids.items() if self.bids.get(i) != bid]
+
+    def set_bids(self, new_bids: dict, dry_run=False) -> list:
+        """
+        Отправляет измененные ставки через KeywordBids.set пачками по set_limit шт. в max_workers потоков.
+        Ошибки по отдельным ставкам и по целым пачкам (исчерпаны попытки, разомкнута цепь и т.п.)
+        не прерывают обновление и собираются в self.errors (очищается при каждом вызове).
+        Ограничение времени задания (self.retry_policy.job) действует и на запросы из потоков пула
+        https://yandex.ru/dev/direct/doc/ref-v5/keywordbids/set.html
+
+        :param new_bids: dict KeywordId -> новая ставка
+        :param dry_run: True - только вернуть изменения, не отправляя их в API
+        :return: список изменений (см. diff)
+        """
+        self.errors = []
+        changes = self.diff(new_bids)
+        logger.info(f"Изменяется ставок: {len(changes)} из {len(new_bids)}")
+        if dry_run or not changes:
+            return changes
+
+        parts = [changes[i:i+self.set_limit] for i in range(0, len(changes), self.set_limit)]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            deadline = self.retry_policy.job_deadline  # ограничение задания вызывающего потока
+            futures = [(part, executor.submit(self.__set_bids, part, deadline)) for part in parts]
+            for part, future in futures:
+                try:
+                    results = future.result()
+                except Exception as err:  # LimitOfRetryError, CircuitOpenError, DeadlineExceededError и т.п.
+                    logger.error(f"Пачка из {len(part)} ставок не отправлена: {type(err).__name__} {err}")
+                    self.errors.extend({"KeywordId": i['KeywordId'], "Errors": [{"Message": type(err).__name__}]}
+                                       for i in part)
+                    continue
+                for item, res in zip(part, results):
+                    if res.get('Errors', False):
+                        self.errors.append({"KeywordId": item['KeywordId'], "Errors": res['Errors']})
+                    else:
+                        self.bids[item['KeywordId']] = item['NewBid']
+        if self.errors:
+            logger.error(f"Ошибок при установке ставок: {len(self.errors)}")
+        return changes
+
+    def __set_bids(self, part, deadline=None):
+        body = {"method": 'set',
+                "params": {
+                    "KeywordBids": [{"KeywordId": i['KeywordId'], "SearchBid": i['NewBid']} for i in part]
+                }
+                }
+        with self.retry_policy.job_until(deadline):
+            return self.send_request(body, "KeywordBids", strict=False).json()['result']['SetResults']
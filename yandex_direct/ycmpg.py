@@ -9,11 +9,13 @@ logger = constants.logging.getLogger(__name__)
 
 
 class YCampaigns(ydbase.YandexDirectBase):
-    def __init__(self, directory=None, dump_file_prefix="ycmpg", cache=False, account="default", login="default"):
+    def __init__(self, directory=None, dump_file_prefix="ycmpg", cache=False, account="default", login="default",
+                 lazy=False):
         if directory is None:
             directory = f"{ENVI['MAIN_PYSEA_DIR']}alldata/cache"
         super(YCampaigns, self).__init__(directory=directory, dump_file_prefix=dump_file_prefix, cache=cache, account=account, login=login)
-        self.data = self.__get_campaigns()
+        # lazy=True - не загружать все кампании в self.data, данные получаются потоково через iter_campaigns()
+        self.data = [] if lazy else self.__get_campaigns()
         self.ids_enabled = {i['Id'] for i in self.data if i['State'] == 'ON'}
 
     def __str__(self):
@@ -27,8 +29,26 @@ class YCampaigns(ydbase.YandexDirectBase):
 
     @ydbase.dump_to("campaigns")  # кешируем в файл
     @ydbase.limit_by(500)  # получаем ответ по страницам
-    @ydbase.connection_attempts()  # делает доп попытки в случае возникновения ConnectionError
     def __get_campaigns(self):
+        return self.__get_campaigns_page()
+
+    @ydbase.dump_pages_to("campaigns_pages")  # кешируем в файл постранично
+    @ydbase.iter_by(500)  # отдаем ответ по страницам по мере получения
+    def __iter_campaigns_pages(self):
+        return self.__get_campaigns_page()
+
+    def iter_campaigns(self, pages=False):
+        """
+        Потоковое получение кампаний без накопления всего ответа в памяти
+
+        :param pages: True - отдавать страницы (списки кампаний), False - отдельные кампании
+        :return: генератор
+        """
+        if pages:
+            return self.__iter_campaigns_pages()
+        return ydbase.iter_objects(self.__iter_campaigns_pages())
+
+    def __get_campaigns_page(self):
         """
         Реализует метод API:
         https://tech.yandex.ru/direct/doc/ref-v5/campaigns/get-docpage/
@@ -104,13 +124,15 @@ class YCampaigns(ydbase.YandexDirectBase):
 
 
 class YGroups(ydbase.YandexDirectBase):
-    def __init__(self, campaign_ids, directory=None, dump_file_prefix="ygroups", cache=False, account="default", login="default"):
+    def __init__(self, campaign_ids, directory=None, dump_file_prefix="ygroups", cache=False, account="default", login="default",
+                 lazy=False):
         if directory is None:
             directory = f"{ENVI['MAIN_PYSEA_DIR']}alldata/cache"
         super(YGroups, self).__init__(directory=directory, dump_file_prefix=dump_file_prefix, cache=cache, account=account, login=login)
 
         self.campaign_ids = campaign_ids
-        self.data = self.__get_adgroups(campaign_ids)
+        # lazy=True - не загружать все группы в self.data, данные получаются потоково через iter_adgroups()
+        self.data = [] if lazy else self.__get_adgroups(campaign_ids)
 
     def __str__(self):
         return f"<<Группы Яндекс Директ {len(self.data)} для кампаний {self.campaign_ids}>>"
@@ -130,8 +152,27 @@ class YGroups(ydbase.YandexDirectBase):
     @ydbase.dump_to("groups")
     @ydbase.main_array_limit(1)
     @ydbase.limit_by(200)
-    @ydbase.connection_attempts()
     def __get_adgroups(self, campaign_ids):
+        return self.__get_adgroups_page(campaign_ids)
+
+    @ydbase.dump_pages_to("groups_pages")
+    @ydbase.iter_array_limit(1)
+    @ydbase.iter_by(200)
+    def __iter_adgroups_pages(self, campaign_ids):
+        return self.__get_adgroups_page(campaign_ids)
+
+    def iter_adgroups(self, pages=False):
+        """
+        Потоковое получение групп для self.campaign_ids без накопления всего ответа в памяти
+
+        :param pages: True - отдавать страницы (списки групп), False - отдельные группы
+        :return: генератор
+        """
+        if pages:
+            return self.__iter_adgroups_pages(self.campaign_ids)
+        return ydbase.iter_objects(self.__iter_adgroups_pages(self.campaign_ids))
+
+    def __get_adgroups_page(self, campaign_ids):
         """
         Реализует метод API:
         https://tech.yandex.ru/direct/doc/ref-v5/adgroups/get-docpage/
@@ -3,14 +3,29 @@ import json
 import requests
 import curlify
 import re
+import os
+import threading
 from time import sleep
+from time import monotonic
+from random import uniform
+from contextlib import contextmanager
 from datetime import date
 from datetime import timedelta
 from common_constants import constants
 from google_analytics.analyticsbase import DateDeque
-from urllib.request import urlopen
 from urllib3.exceptions import ProtocolError
 import pickle
+import mmap
+import math
+import sys
+import hashlib
+from types import MappingProxyType
+from collections.abc import Mapping
+from array import array
+from itertools import repeat
+from itertools import groupby
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 ENVI = constants.EnviVar(
     main_dir="/home/eugene/Yandex.Disk/localsource/yandex_direct/",
     cred_dir="/home/eugene/Yandex.Disk/localsource/credentials/"
@@ -19,8 +34,11 @@ logger = constants.logging.getLogger(__name__)
 
 
 class YandexDirectError(constants.PySeaError): pass
-class InternalYDServerError(YandexDirectError): pass
+class InternalYDServerError(YandexDirectError):
+    retry_in = None  # подсказка сервера о паузе перед повтором (секунды), см. RetryPolicy
 class LimitOfRetryError(YandexDirectError): pass
+class DeadlineExceededError(LimitOfRetryError): pass
+class CircuitOpenError(YandexDirectError): pass
 class IntegrityDataError(YandexDirectError): pass
 class PeriodError(YandexDirectError): pass
 
@@ -52,6 +70,49 @@ def limit_by(nlim):  # конструктор декоратора (L залип
     return deco_limit
 
 
+def iter_by(nlim):  # конструктор декоратора (L залипает в замыкании)
+    """
+    Декоратор для потоковой постраничной выборки в вызовах API Яндекс Директ.
+    В отличие от limit_by не накапливает результат, а превращает функцию в генератор,
+    отдающий страницы (списки объектов) по мере их получения от сервера
+    https://tech.yandex.ru/direct/doc/dg/best-practice/get-docpage/#page
+
+    :param nlim: не более 10 000 объектов за один запрос. (для метода get)
+    :return:
+    """
+    def deco_iter(f):  # собственно декоратор принимающий функцию для декорирования
+        def constructed_function(self, *argp, **argn):  # конструируемая функция
+            # позиция генератора хранится локально, а self.limit_by / self.offset выставляются
+            # только на время синхронного запроса страницы, поэтому между yield объект можно
+            # использовать для других постраничных вызовов (в том числе других iter_*)
+            offset = 0
+            while True:
+                self.limit_by, self.offset = nlim, offset
+                try:
+                    data = f(self, *argp, **argn)
+                finally:
+                    self.offset = 0  # возвращаем пагенатор в исходное состояние для следующих вызовов
+
+                if data[0]:
+                    yield data[0]
+                if not data[1]:
+                    break
+                offset = data[1]
+        return constructed_function
+    return deco_iter
+
+
+def iter_objects(pages):
+    """
+    Разворачивает поток страниц (из генератора, декорированного iter_by) в поток объектов
+
+    :param pages: иттерируемый набор страниц
+    :return: генератор объектов
+    """
+    for page in pages:
+        yield from page
+
+
 def dump_to(prefix, d=False):  # конструктор декоратора (n залипает в замыкании)
     """
     Декоратор для кеширования возврата функции.
@@ -104,44 +165,259 @@ def dump_to(prefix, d=False):  # конструктор декоратора (n
     return deco_dump
 
 
-def connection_attempts(n=12, t=10):  # конструктор декоратора (N,T залипает в замыкании)
+def dump_pages_to(prefix):  # конструктор декоратора (prefix залипает в замыкании)
     """
-    Декоратор задает n попыток для соединения с сервером в случае ряда исключений
-    с задержкой t*2^i секунд
+    Декоратор для постраничного кеширования генераторов (см. iter_by).
+    Применим к методам класса, в котором объявлены:
+    self.directory - ссылка на каталог
+    self.dump_file_prefix - файловый префикс
+    self.cache - True - кеширование требуется / False
 
-    :param n: количество попыток соединения с сервером [1, 15]
-    :param t: количество секунд задержки на первой попытке попытке (на i'ом шаге t*2^i)
+    Страницы записываются в файл по одной (последовательные pickle.dump) сразу по мере получения,
+    поэтому в памяти одновременно находится не более одной страницы.
+    Данные пишутся во временный файл *.part, который переименовывается только после получения
+    последней страницы, так что недочитанный генератор не оставляет после себя неполный кеш.
+
+    :param prefix: идентифицирует декорируемую кешируемую функцию
     :return:
     """
-    def deco_connect(f):  # собственно декоратор принимающий функцию для декорирования
-        def constructed_function(*argp, **argn):  # конструируемая функция
-            retry_flag, pause_seconds = n, t
-            try_number = 0
+    def deco_dump(f):  # собственно декоратор принимающий функцию для декорирования
+        def constructed_function(self, *argp, **argn):  # конструируемая функция
+            file_out = "{}/{}_{}_{}.pickle".format(self.directory, self.dump_file_prefix, prefix,
+                                                   date.today()).replace("//", "/")
+
+            if self.cache and os.path.isfile(file_out):  # пробуем читать страницы из файла
+                with open(file_out, "rb") as file:
+                    while True:
+                        try:
+                            page = pickle.load(file)
+                        except EOFError:
+                            return
+                        yield page
+
+            file_part = f"{file_out}.part"
+            with open(file_part, "wb") as file:  # записываем страницы в файл по мере получения
+                for page in f(self, *argp, **argn):
+                    pickle.dump(page, file, pickle.HIGHEST_PROTOCOL)
+                    yield page
+            os.replace(file_part, file_out)
+        return constructed_function
+    return deco_dump
 
-            if retry_flag < 0 or retry_flag > 15:
-                retry_flag = 8
-            if pause_seconds < 1 or pause_seconds > 30:
-                pause_seconds = 10
 
-            while True:
-                try:
-                    result = f(*argp, **argn)
-                    # Обработка ошибки, если не удалось соединиться с сервером
-                except (ConnectionError,
-                        requests.exceptions.ConnectionError,
-                        requests.exceptions.ChunkedEncodingError,
-                        ProtocolError,
-                        InternalYDServerError) as err:
-                    logger.error(f"Ошибка соединения с сервером {err}. Осталось попыток {retry_flag - try_number}")
-                    if try_number >= retry_flag:
-                        raise LimitOfRetryError
-                    sleep(pause_seconds * 2 ** try_number)
-                    try_number += 1
-                    continue
-                else:
-                    return result
+RETRY_EXCEPTIONS = (ConnectionError,
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError,
+                    ProtocolError,
+                    InternalYDServerError)
+
+
+class CircuitBreaker:
+    """
+    Размыкатель цепи для одного сервиса API (общий для всех объектов процесса с той же настройкой,
+    см. CircuitBreaker.get).
+    После threshold подряд неудачных запросов цепь размыкается на reset_timeout секунд,
+    и все запросы к сервису сразу завершаются CircuitOpenError, не занимая воркеры ожиданием.
+    По истечении reset_timeout пропускается один пробный запрос: успех замыкает цепь, неудача снова размыкает.
+    Ответ сервиса с ошибкой, не связанной с доступностью (YandexDirectError и т.п.), считается успехом
+    """
+    registry = {}
+    registry_lock = threading.Lock()
+
+    def __init__(self, service, threshold=5, reset_timeout=60):
+        self.service = service
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get(cls, service, threshold=5, reset_timeout=60):
+        """
+        Общий размыкатель цепи для сервиса. Реестр ведется по сервису и настройке (threshold, reset_timeout),
+        поэтому политика с другой настройкой получает свой размыкатель, а не настройку первого вызова
+        """
+        key = (service, threshold, reset_timeout)
+        with cls.registry_lock:
+            if key not in cls.registry:
+                cls.registry[key] = cls(service, threshold, reset_timeout)
+            return cls.registry[key]
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return None
+            if monotonic() - self.opened_at >= self.reset_timeout and not self.trial:
+                self.trial = True  # полуоткрытое состояние, пропускаем один пробный запрос
+                return None
+        logger.error(f"Цепь для сервиса {self.service} разомкнута, запрос не выполняется")
+        raise CircuitOpenError
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                if self.opened_at is None or self.trial:
+                    logger.error(f"Цепь для сервиса {self.service} разомкнута на {self.reset_timeout} секунд")
+                self.opened_at = monotonic()
+                self.trial = False
+
+    def cancel_trial(self):
+        """
+        Пробный запрос прерван без ответа сервиса (KeyboardInterrupt и т.п.) - разрешаем следующий пробный запрос
+        """
+        with self.lock:
+            self.trial = False
+
+
+class RetryPolicy:
+    """
+    Политика повторных попыток для запросов к API в случае ошибок из RETRY_EXCEPTIONS.
+
+    Пауза перед i-й повторной попыткой - случайная величина из [0, min(cap, base*2^i)] (full jitter),
+    чтобы воркеры не повторяли запросы синхронно. Если сервер прислал подсказку retry_in, пауза берется из нее.
+    Общее время одного вызова ограничено deadline секунд, время задания - через контекст job()
+    (ограничение задания действует в потоке, открывшем контекст, в другие потоки передается через job_until()).
+    Если очередная пауза не укладывается в оставшееся время, сразу выбрасывается DeadlineExceededError.
+    Неудачи учитываются в CircuitBreaker сервиса: если цепь разомкнута к началу вызова, он сразу завершается
+    CircuitOpenError, а уже начатый вызов продолжает попытки до attempts / deadline.
+    """
+    def __init__(self, attempts=12, base=10, cap=600, deadline=3600, breaker_threshold=5, breaker_timeout=60):
+        """
+        :param attempts: количество повторных попыток
+        :param base: базовая пауза в секундах
+        :param cap: максимальная пауза в секундах (None - без ограничения)
+        :param deadline: ограничение времени одного вызова в секундах (None - без ограничения)
+        :param breaker_threshold: количество неудач подряд, после которого размыкается цепь сервиса
+                                  (None - размыкатель цепи не используется)
+        :param breaker_timeout: время в секундах, на которое размыкается цепь сервиса
+        """
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.deadline = deadline
+        self.breaker_threshold = breaker_threshold
+        self.breaker_timeout = breaker_timeout
+        self.__local = threading.local()  # ограничение задания у каждого потока свое
+
+    @property
+    def job_deadline(self):
+        """
+        Момент monotonic(), после которого задание текущего потока прекращает попытки (None - без ограничения)
+        """
+        return getattr(self.__local, 'deadline', None)
+
+    def job(self, seconds):
+        """
+        Ограничивает время всех вызовов внутри блока with
+        :param seconds: ограничение времени задания в секундах
+        """
+        return self.job_until(monotonic() + seconds)
+
+    @contextmanager
+    def job_until(self, deadline):
+        """
+        Ограничивает время всех вызовов внутри блока with моментом monotonic() deadline.
+        Используется для передачи ограничения задания (job_deadline) в потоки пула
+        :param deadline: момент monotonic() или None - без дополнительного ограничения
+        """
+        previous = self.job_deadline
+        if deadline is not None and previous is not None:
+            deadline = min(previous, deadline)
+        self.__local.deadline = previous if deadline is None else deadline
+        try:
+            yield self
+        finally:
+            self.__local.deadline = previous
 
+    def time_left(self, call_deadline=None):
+        limits = [i for i in (call_deadline, self.job_deadline) if i is not None]
+        if not limits:
             return None
+        return min(limits) - monotonic()
+
+    def delay(self, try_number, retry_in=None):
+        if retry_in:
+            return retry_in + uniform(0, retry_in * 0.1)
+        pause = self.base * 2 ** try_number
+        return uniform(0, pause if self.cap is None else min(self.cap, pause))
+
+    def sleep(self, seconds, call_deadline=None):
+        """
+        Пауза с учетом ограничений времени вызова и задания
+        """
+        left = self.time_left(call_deadline)
+        if left is not None and seconds > left:
+            logger.error(f"Пауза {seconds:.0f} сек. не укладывается в оставшееся время {max(left, 0):.0f} сек.")
+            raise DeadlineExceededError
+        sleep(seconds)
+
+    def call(self, f, *argp, service="default", **argn):
+        """
+        Выполняет f(*argp, **argn) с повторными попытками
+
+        :param f: вызываемая функция
+        :param service: имя сервиса для размыкателя цепи
+        :return: результат f
+        """
+        if self.breaker_threshold is None:
+            breaker = CircuitBreaker(service, math.inf, 0)  # собственный, никогда не размыкающийся
+        else:
+            breaker = CircuitBreaker.get(service, self.breaker_threshold, self.breaker_timeout)
+        call_deadline = monotonic() + self.deadline if self.deadline is not None else None
+        try_number = 0
+
+        breaker.before_call()  # если сервис уже недоступен, не занимаем воркер ожиданием
+        while True:
+            try:
+                result = f(*argp, **argn)
+            except RETRY_EXCEPTIONS as err:
+                breaker.failure()
+                logger.error(f"Ошибка соединения с сервером {err}. Осталось попыток {self.attempts - try_number}")
+                if try_number >= self.attempts:
+                    raise LimitOfRetryError
+                self.sleep(self.delay(try_number, getattr(err, 'retry_in', None)), call_deadline)
+                try_number += 1
+            except Exception:
+                breaker.success()  # сервис ответил, ошибка не связана с его доступностью
+                raise
+            except BaseException:
+                breaker.cancel_trial()
+                raise
+            else:
+                breaker.success()
+                return result
+
+
+def connection_attempts(n=12, t=10):  # конструктор декоратора (N,T залипает в замыкании)
+    """
+    Декоратор задает n попыток для соединения с сервером в случае ряда исключений (см. RetryPolicy)
+    с задержкой, случайной из [0, t*2^i] секунд, после n неудачных повторов - LimitOfRetryError.
+    Без ограничения времени и без размыкателя цепи, как и раньше.
+    Запросы YandexDirectBase уже выполняются с повторными попытками по self.retry_policy,
+    декоратор оставлен для пользовательских функций
+
+    :param n: количество попыток соединения с сервером [1, 15]
+    :param t: базовая задержка в секундах (на i'ом шаге случайная из [0, t*2^i])
+    :return:
+    """
+    if n < 0 or n > 15:
+        n = 8
+    if t < 1 or t > 30:
+        t = 10
+    policy = RetryPolicy(attempts=n, base=t, cap=None, deadline=None, breaker_threshold=None)
+
+    def deco_connect(f):  # собственно декоратор принимающий функцию для декорирования
+        def constructed_function(*argp, **argn):  # конструируемая функция
+            return policy.call(f, *argp, service=f.__qualname__, **argn)
         return constructed_function
     return deco_connect
 
@@ -197,9 +473,686 @@ def main_array_limit(nlim):  # конструктор декоратора (L з
     return deco_list_limit
 
 
+def iter_array_limit(nlim):  # конструктор декоратора (L залипает в замыкании)
+    """
+    Потоковый аналог main_array_limit для генераторов (см. iter_by):
+    разбивает первый переданный список на части по nlim шт. и последовательно
+    отдает все страницы, полученные для каждой из частей
+
+    :param nlim: количество CampaignIds в одном API запросе
+    :return:
+    """
+    def deco_list_limit(f):  # собственно декоратор принимающий функцию для декорирования
+        def constructed_function(self, lst, *argp, **argn):  # конструируемая функция
+            if type(lst) is str:
+                lst = [int(lst)]
+            elif type(lst) is int:
+                lst = [lst]
+
+            for i in range(0, len(lst), nlim):
+                yield from f(self, lst[i:i+nlim], *argp, **argn)
+        return constructed_function
+    return deco_list_limit
+
+
+NEGATIVE_KEYWORDS = re.compile(r"\s-.*$")  # минус-слова в тексте ключевой фразы
+KEYWORD_OPERATORS = re.compile(r'[+!"\[\]]')  # операторы ключевых фраз
+TSV_INT_FIELDS = ('CampaignId', 'AdGroupId', 'CriteriaId', 'Impressions', 'Clicks', 'Cost')
+TSV_FLOAT_FIELDS = ('AvgImpressionPosition', 'AvgClickPosition', 'AvgTrafficVolume')
+
+
+def _convert_tsv_lines(fields: list, lines: list) -> list:
+    """
+    Приводит типы известных полей для набора строк TSV отчета построчно.
+    Используется для нестандартных строк (короче заголовка), основной путь - _convert_tsv_chunk
+
+    :param fields: имена полей из заголовка отчета
+    :param lines: строки отчета
+    :return: список строк со значениями приведенных типов
+    """
+    last = {f: n for n, f in enumerate(fields)}  # как и dict(zip(...)) учитываем последнее поле с таким именем
+    int_idx = [last[f] for f in TSV_INT_FIELDS if f in last]
+    float_idx = [last[f] for f in TSV_FLOAT_FIELDS if f in last]
+    date_idx = last.get('Date', None)
+    nfields = len(fields)
+    fromisoformat = date.fromisoformat
+
+    rows = []
+    for i in lines:
+        row = i.split("\t", nfields)[:nfields]
+        size = len(row)
+        for n in int_idx:
+            if n < size and row[n]:
+                row[n] = "undefined" if row[n] == "--" else int(row[n])
+        for n in float_idx:
+            if n < size and row[n]:
+                row[n] = None if row[n].find("-") != -1 else float(row[n])
+        if date_idx is not None and date_idx < size and row[date_idx]:
+            row[date_idx] = fromisoformat(row[date_idx])
+        rows.append(row)
+    return rows
+
+
+def _convert_tsv_column(kind: str, col: list) -> tuple:
+    """
+    Приводит типы одной колонки. Быстрый путь - преобразование всей колонки в array на уровне C,
+    при ошибке (sentinel "--", "-", пустые значения) - поэлементно с записью исключений
+
+    :return: (payload, exceptions) где exceptions - dict номер строки -> значение
+    """
+    exc = {}
+    if kind == "q":
+        try:
+            return array("q", map(int, col)), exc
+        except ValueError:
+            values = array("q")
+            for j, v in enumerate(col):
+                if v and v != "--":
+                    values.append(int(v))
+                else:
+                    values.append(0)
+                    exc[j] = "undefined" if v else v
+            return values, exc
+    elif kind == "d":
+        if "-" not in "".join(col):
+            try:
+                return array("d", map(float, col)), exc
+            except ValueError:
+                pass
+        values = array("d")
+        for j, v in enumerate(col):
+            if v and v.find("-") == -1:
+                values.append(float(v))
+            else:
+                values.append(0.0)
+                exc[j] = None if v else v
+        return values, exc
+    elif kind == "date":
+        memo = {}
+        values = array("i")
+        for j, v in enumerate(col):
+            ordinal = memo.get(v)
+            if ordinal is None:
+                ordinal = memo[v] = date.fromisoformat(v).toordinal() if v else 0
+            if not ordinal:
+                exc[j] = v
+                ordinal = 1
+            values.append(ordinal)
+        return values, exc
+    return "\t".join(col), exc  # строки из TSV не содержат табуляций, склеиваем в одну строку
+
+
+def _convert_tsv_chunk(fields: list, lines: list) -> tuple:
+    """
+    Приводит типы для части строк TSV отчета и возвращает компактный колоночный результат:
+    числа и даты в array (ordinal для дат), строковые колонки одной строкой.
+    Функция уровня модуля, чтобы ее можно было выполнять в пуле процессов,
+    результат передается в основной процесс без сериализации отдельных объектов Python
+
+    :param fields: имена полей из заголовка отчета
+    :param lines: строки отчета
+    :return: (количество строк, [(имя поля, тип, payload, исключения)], {номер строки: dict} для коротких строк)
+    """
+    last = {f: n for n, f in enumerate(fields)}  # как и dict(zip(...)): порядок первого поля, значение последнего
+    nfields = len(fields)
+    rows, short = [], {}
+    for j, i in enumerate(lines):
+        row = i.split("\t", nfields)[:nfields]
+        if len(row) < nfields:
+            short[j] = dict(zip(fields, _convert_tsv_lines(fields, [i])[0]))
+            row = [""] * nfields
+        rows.append(row)
+
+    columns = []
+    for name, n in last.items():
+        if name in TSV_INT_FIELDS:
+            kind = "q"
+        elif name in TSV_FLOAT_FIELDS:
+            kind = "d"
+        elif name == "Date":
+            kind = "date"
+        else:
+            kind = "s"
+        columns.append((name, kind) + _convert_tsv_column(kind, [r[n] for r in rows]))
+    return len(rows), columns, short
+
+
+class ColumnRows:
+    """
+    Строки отчета, хранящиеся по колонкам: числа в array, даты как ordinal в array, строки списками.
+    Поддерживает len(), индексацию и итерацию как список строк, но строка собирается только при обращении
+    к ней и доступна только для чтения (MappingProxyType, изменяемая копия - dict(row)).
+    Колонка целиком доступна через column().
+
+    Значения, не укладывающиеся в тип колонки ("undefined", "", None), хранятся в исключениях,
+    строки короче заголовка отчета - целиком в short.
+    """
+    def __init__(self, kinds: dict, columns: dict, exceptions: dict, short: dict, size: int) -> None:
+        self.kinds = kinds  # имя поля -> "q" / "d" / "date" / "s" (порядок полей как в dict строки)
+        self.fields = list(kinds)
+        self._columns = columns  # имя поля -> значения колонки
+        self._exceptions = exceptions  # имя поля -> {номер строки: значение}
+        self._short = short  # номер строки -> dict
+        self.rows = size
+        self._dates = {}  # ordinal -> date
+        self._groups = None  # (order, bounds), см. groups()
+
+    @classmethod
+    def from_chunks(cls, chunks) -> ColumnRows:
+        """
+        Склеивает результаты _convert_tsv_chunk. Числовые колонки склеиваются на уровне C
+        без создания объектов Python для отдельных значений
+        """
+        kinds, columns, exceptions, short, size = {}, {}, {}, {}, 0
+        for chunk_size, chunk_columns, chunk_short in chunks:
+            for name, kind, payload, exc in chunk_columns:
+                if name not in kinds:
+                    kinds[name] = kind
+                    columns[name] = [] if kind == "s" else array(payload.typecode)
+                    exceptions[name] = {}
+                if kind == "s":
+                    if chunk_size:
+                        columns[name].extend(payload.split("\t"))
+                else:
+                    columns[name].extend(payload)
+                exceptions[name].update((j + size, v) for j, v in exc.items())
+            short.update((j + size, v) for j, v in chunk_short.items())
+            size += chunk_size
+        return cls(kinds, columns, exceptions, short, size)
+
+    def column(self, name: str):
+        """
+        Колонка целиком без сборки строк (array для чисел, ordinal для дат). Исключения см. exceptions()
+        """
+        return self._columns[name]
+
+    def exceptions(self, name: str) -> dict:
+        return self._exceptions[name]
+
+    def _date(self, ordinal: int) -> date:
+        value = self._dates.get(ordinal)
+        if value is None:
+            value = self._dates[ordinal] = date.fromordinal(ordinal)
+        return value
+
+    def value(self, name: str, i: int):
+        """
+        Значение поля name в строке i без сборки всей строки
+        """
+        if i in self._short:
+            return self._short[i][name]
+        exc = self._exceptions[name]
+        if i in exc:
+            return exc[i]
+        if self.kinds[name] == "date":
+            return self._date(self._columns[name][i])
+        return self._columns[name][i]
+
+    def values(self, name: str, indices):
+        """
+        Значения поля name в строках indices (итератор) без сборки строк.
+        Если поля нет в отчете - None для каждой строки
+
+        :param indices: номера строк (последовательность, по которой можно пройти несколько раз)
+        """
+        kind = self.kinds.get(name)
+        if kind is None:
+            return repeat(None, len(indices))
+        if self._short:
+            short, value = self._short, partial(self.value, name)
+            return (short[i].get(name) if i in short else value(i) for i in indices)
+        exc = self._exceptions[name]
+        contiguous = type(indices) is range and indices.step == 1  # группа строк после grouped()
+        if contiguous:
+            values = self._slice(self._columns[name], indices.start, indices.stop)
+        else:
+            values = map(self._columns[name].__getitem__, indices)
+        if kind == "date":
+            values = map(self._date, values)
+        if not exc:
+            return values
+        if isinstance(exc, _ExceptionCodes):
+            table = [None] + exc.values  # код 0 - значение из колонки
+            if contiguous:
+                codes = self._slice(exc.codes, indices.start, indices.stop)
+            else:
+                codes = map(exc.codes.__getitem__, indices)
+            return (table[c] if c else v for c, v in zip(codes, values))
+        return (exc[i] if i in exc else v for i, v in zip(indices, values))
+
+    @staticmethod
+    def _slice(col, start: int, stop: int):
+        """
+        Значения col[start:stop] одним вызовом на уровне C (список / array)
+        """
+        if isinstance(col, memoryview):
+            return col[start:stop].tolist()
+        if isinstance(col, _StringColumn):
+            return col.slice(start, stop)
+        return col[start:stop]
+
+    def groups(self) -> tuple:
+        """
+        Группировка строк по дате и кампании в порядке TSVReportByDate: даты по возрастанию
+        (устойчивая сортировка), внутри даты - кампании в порядке первого появления, внутри кампании -
+        строки в исходном порядке. Сортировка идет по колонкам Date / CampaignId без сборки строк,
+        результат запоминается (для снимка читается из файла)
+
+        :return: (order, bounds) - номера строк (array) и границы групп: k-я группа - order[bounds[k]:bounds[k + 1]]
+        """
+        if self._groups is None:
+            order, bounds = array("q"), array("q", [0])
+            date_key, campaign_key = self.__key('Date'), self.__key('CampaignId')
+            for _, day in groupby(sorted(range(self.rows), key=date_key), key=date_key):
+                campaigns = {}
+                for i in day:
+                    campaign_id = campaign_key(i)
+                    rows = campaigns.get(campaign_id)
+                    if rows is None:
+                        rows = campaigns[campaign_id] = array("q")
+                    rows.append(i)
+                for rows in campaigns.values():
+                    order.extend(rows)
+                    bounds.append(len(order))
+            if order == array("q", range(self.rows)):  # строки уже сгруппированы (см. grouped)
+                order = range(self.rows)
+            self._groups = order, bounds
+        return self._groups
+
+    def grouped(self) -> ColumnRows:
+        """
+        Строки в порядке groups(): каждая группа по дате и кампании - непрерывный диапазон строк,
+        поэтому колонки группы читаются срезом (см. values). Если строки уже в этом порядке - self
+
+        :return: ColumnRows
+        """
+        order, bounds = self.groups()
+        if type(order) is range:
+            return self
+        position = array("q", bytes(8 * self.rows))  # старый номер строки -> новый
+        for j, i in enumerate(order):
+            position[i] = j
+        columns, exceptions = {}, {}
+        for name, kind in self.kinds.items():
+            col = self._columns[name]
+            if kind in ("s", "pickle"):
+                columns[name] = list(map(col.__getitem__, order))
+            else:
+                columns[name] = array({"q": "q", "d": "d", "date": "i"}[kind], map(col.__getitem__, order))
+            exceptions[name] = {position[i]: v for i, v in self._exceptions[name].items()}
+        short = {position[i]: v for i, v in self._short.items()}
+        result = ColumnRows(dict(self.kinds), columns, exceptions, short, self.rows)
+        result._groups = range(self.rows), bounds
+        return result
+
+    def __key(self, name: str):
+        if self._short or self._exceptions[name]:
+            return partial(self.value, name)
+        return self._columns[name].__getitem__  # ordinal для дат, порядок тот же
+
+    def select(self, indices, drop: tuple = (), start: int = 0, stop: int = None) -> ColumnRowsView:
+        """
+        Представление строк indices[start:stop] (см. ColumnRowsView)
+        """
+        return ColumnRowsView(self, indices, drop, start, stop)
+
+    @classmethod
+    def from_rows(cls, rows: list) -> ColumnRows:
+        """
+        Раскладывает список dict по колонкам. Значения, не совпадающие с типом колонки
+        (строки и None в числовых колонках, None в строковых), хранятся как исключения,
+        колонки смешанных типов - списком объектов (kind "pickle"),
+        строки с другим набором полей - целиком в short
+        """
+        fields = []
+        for row in rows:
+            if len(row) > len(fields):
+                fields = list(row)
+
+        short = {}
+        for j, row in enumerate(rows):
+            if len(row) != len(fields) or list(row) != fields:
+                short[j] = dict(row)
+
+        kinds, columns, exceptions = {}, {}, {}
+        for name in fields:
+            col = [None if j in short else row[name] for j, row in enumerate(rows)]
+            types = {type(i) for i in col} - {str, type(None)}
+            kind = {frozenset(): "s", frozenset({int}): "q", frozenset({float}): "d",
+                    frozenset({date}): "date"}.get(frozenset(types), "pickle")
+            exc = {}
+            if kind == "s":
+                exc = {j: v for j, v in enumerate(col) if v is None and j not in short}
+                values = ["" if v is None else v for v in col]
+            elif kind != "pickle":
+                exc = {j: v for j, v in enumerate(col) if type(v) is not {"q": int, "d": float, "date": date}[kind]
+                       and j not in short}
+                placeholder = {"q": 0, "d": 0.0, "date": 1}[kind]
+                try:
+                    values = array({"q": "q", "d": "d", "date": "i"}[kind],
+                                   [placeholder if j in exc or j in short else (v.toordinal() if kind == "date" else v)
+                                    for j, v in enumerate(col)])
+                except OverflowError:  # целые вне int64
+                    kind, exc = "pickle", {}
+            if kind == "pickle":
+                values = col
+            kinds[name], columns[name], exceptions[name] = kind, values, exc
+        return cls(kinds, columns, exceptions, short, len(rows))
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def row(self, i: int, drop: tuple = ()) -> dict:
+        """
+        Новый dict строки i без полей drop
+        """
+        if i in self._short:
+            return {k: v for k, v in self._short[i].items() if k not in drop}
+        row = {}
+        for name, kind in self.kinds.items():
+            if name in drop:
+                continue
+            exc = self._exceptions[name]
+            if i in exc:
+                row[name] = exc[i]
+            elif kind == "date":
+                row[name] = self._date(self._columns[name][i])
+            else:
+                row[name] = self._columns[name][i]
+        return row
+
+    def __getitem__(self, i: int) -> MappingProxyType:
+        if i < 0:
+            i += self.rows
+        if not 0 <= i < self.rows:
+            raise IndexError
+        return MappingProxyType(self.row(i))
+
+    def __iter__(self):
+        for i in range(self.rows):
+            yield self[i]
+
+
+class ColumnRowsView:
+    """
+    Часть строк ColumnRows с номерами indices[start:stop], без копирования данных (срез не создается,
+    поэтому представления над снимком не удерживают его буфер).
+    Используется TSVReportByDate для группировки по датам и кампаниям, поля drop из строк исключаются.
+    Для расчетов по колонкам - values(), без сборки строк
+    """
+    def __init__(self, source: ColumnRows, indices, drop: tuple = (), start: int = 0, stop: int = None) -> None:
+        self.source = source
+        self.indices = indices
+        self.drop = drop
+        self.start = start
+        self.stop = len(indices) if stop is None else stop
+
+    def __len__(self) -> int:
+        return self.stop - self.start
+
+    def __getitem__(self, k: int) -> MappingProxyType:
+        if not 0 <= k < len(self):
+            raise IndexError
+        return MappingProxyType(self.source.row(self.indices[self.start + k], self.drop))
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def values(self, name: str):
+        """
+        Значения поля name по строкам представления (см. ColumnRows.values)
+        """
+        return self.source.values(name, self.indices[self.start:self.stop])
+
+
+SNAPSHOT_MAGIC = b"YDSNAP04"
+
+
+class _StringColumn:
+    """
+    Строковая колонка снимка: таблица смещений (uint64) и utf-8 данные, строка декодируется при обращении.
+    Если ни одна строка не содержит табуляции (как в TSV отчете), каждая строка в данных завершается
+    табуляцией (separated) и диапазон строк декодируется одним вызовом (см. slice)
+    """
+    def __init__(self, offsets, blob, separated: bool = False) -> None:
+        self.offsets = offsets
+        self.blob = blob
+        self.separated = separated
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1] - self.separated]).decode("utf8")
+
+    def slice(self, start: int, stop: int) -> list:
+        if not self.separated:
+            return [self[i] for i in range(start, stop)]
+        if start >= stop:
+            return []
+        return bytes(self.blob[self.offsets[start]:self.offsets[stop] - 1]).decode("utf8").split("\t")
+
+    def release(self) -> None:
+        self.offsets.release()
+        self.blob.release()
+
+
+class _ExceptionCodes(Mapping):
+    """
+    Исключения колонки снимка: массив кодов по строкам (0 - значение хранится в колонке,
+    k - значение values[k - 1]), поэтому открытие снимка не зависит от количества исключений
+    """
+    def __init__(self, codes, values: list, count: int) -> None:
+        self.codes = codes
+        self.values = values
+        self.count = count
+
+    def __contains__(self, i) -> bool:
+        return self.codes[i] != 0
+
+    def __getitem__(self, i):
+        code = self.codes[i]
+        if not code:
+            raise KeyError(i)
+        return self.values[code - 1]
+
+    def __iter__(self):
+        return (i for i, code in enumerate(self.codes) if code)
+
+    def __len__(self) -> int:
+        return self.count
+
+    @staticmethod
+    def encode(exc, rows: int) -> tuple:
+        """
+        :param exc: исключения колонки (dict номер строки -> значение)
+        :param rows: количество строк
+        :return: (массив кодов, список значений)
+        """
+        values = {}
+        for v in exc.values():
+            values.setdefault(v, len(values) + 1)
+        typecode = "B" if len(values) < 2 ** 8 else "H" if len(values) < 2 ** 16 else "I"
+        codes = array(typecode, bytes(rows)) if typecode == "B" else array(typecode, [0]) * rows
+        for j, v in exc.items():
+            codes[j] = values[v]
+        return codes, list(values)
+
+
+class ReportSnapshot(ColumnRows):
+    """
+    Бинарный колоночный снимок разобранного отчета, открытый через mmap (ColumnRows над страницами файла).
+    Числовые колонки - memoryview без копирования, строки декодируются и dict собираются только
+    при обращении к строке, поэтому несколько процессов, открывших один снимок, используют одну копию
+    в page cache, а в памяти процесса остаются только исключения и собранные по запросу строки.
+
+    Формат: SNAPSHOT_MAGIC, длина заголовка (uint64), JSON заголовок, секции с выравниванием по 8 байт
+    (смещения секций в заголовке - от конца заголовка). Строки записываются сгруппированными
+    по датам и кампаниям (см. ColumnRows.grouped, порядок строк исходного отчета не сохраняется),
+    границы групп - секцией, поэтому TSVReportByDate над снимком не сортирует строки при открытии
+    и читает колонки группы срезами. Исключения колонок хранятся секцией кодов
+    по строкам (см. _ExceptionCodes), в заголовке - только список различных значений, поэтому размер
+    заголовка и время открытия не зависят от количества строк. Строки с нестандартным набором полей
+    и колонки смешанных типов - в pickle.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, "rb") as file:
+            self.__mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.__mv = memoryview(self.__mm)
+        self.__views = []
+        if bytes(self.__mv[:8]) != SNAPSHOT_MAGIC:
+            self.close()
+            logger.error(f"Файл {path} не является снимком отчета")
+            raise IntegrityDataError
+        header_len = int.from_bytes(self.__mv[8:16], sys.byteorder)
+        self.meta = json.loads(bytes(self.__mv[16:16 + header_len]).decode("utf8"))
+        if self.meta['byteorder'] != sys.byteorder:
+            self.close()
+            logger.error(f"Снимок {path} записан с другим порядком байт")
+            raise IntegrityDataError
+        self.__base = 16 + header_len
+
+        kinds, columns, exceptions = {}, {}, {}
+        for col in self.meta['columns']:
+            kinds[col['name']] = col['kind']
+            columns[col['name']] = self.__open_column(col)
+            exceptions[col['name']] = self.__open_exceptions(col['exceptions']) if col['exceptions'] else {}
+        short = pickle.loads(self.__section(self.meta['short'])) if self.meta['short'] else {}
+        super(ReportSnapshot, self).__init__(kinds, columns, exceptions, short, self.meta['rows'])
+        if self.meta['groups']:  # строки записаны сгруппированными по датам и кампаниям (см. grouped)
+            self._groups = range(self.rows), self.__open_array(self.meta['groups'], "q")
+
+    def __section(self, section: dict) -> memoryview:
+        start = self.__base + section['offset']
+        return self.__mv[start:start + section['length']]
+
+    def __open_column(self, col: dict):
+        data = self.__section(col)
+        if col['kind'] == "pickle":
+            return pickle.loads(data)
+        if col['kind'] == "s":
+            offsets = data[:(self.meta['rows'] + 1) * 8].cast("Q")
+            blob = data[(self.meta['rows'] + 1) * 8:]
+            self.__views.extend((data, offsets, blob))
+            return _StringColumn(offsets, blob, col.get('separated', False))
+        view = data.cast({"q": "q", "d": "d", "date": "i"}[col['kind']])
+        self.__views.extend((data, view))
+        return view
+
+    def __open_exceptions(self, section: dict) -> _ExceptionCodes:
+        return _ExceptionCodes(self.__open_array(section, section['typecode']), section['values'], section['count'])
+
+    def __open_array(self, section: dict, typecode: str) -> memoryview:
+        data = self.__section(section)
+        view = data.cast(typecode)
+        self.__views.extend((data, view))
+        return view
+
+    def close(self) -> None:
+        """
+        Закрывает снимок. Представления, полученные через column() и их срезы, должны быть освобождены
+        (memoryview.release()) до закрытия, иначе закрытие mmap откладывается до сборки мусора
+        """
+        self._columns, self._exceptions = {}, {}
+        for view in reversed(self.__views):
+            view.release()
+        self.__views = []
+        try:
+            self.__mv.release()
+            self.__mm.close()
+        except BufferError:
+            logger.warning(f"Снимок {self.path} используется (есть неосвобожденные memoryview), "
+                           f"закрытие отложено до сборки мусора")
+
+    @staticmethod
+    def save(path: str, rows, report_name: str, period_begin: date, period_end: date) -> None:
+        """
+        Записывает строки отчета (ColumnRows или список dict) в снимок. Запись идет во временный файл,
+        который затем атомарно заменяет path, чтобы другие процессы не открыли недописанный снимок
+        """
+        if not isinstance(rows, ColumnRows):
+            rows = ColumnRows.from_rows(rows)
+        groups = False
+        if 'Date' in rows.kinds and 'CampaignId' in rows.kinds:  # чтобы TSVReportByDate не группировал при открытии
+            try:
+                rows, groups = rows.grouped(), True
+            except (KeyError, TypeError):  # строки без Date / CampaignId или даты разных типов
+                logger.warning(f"Строки снимка {path} не группируются по датам и кампаниям")
+
+        sections, offset = [], 0
+
+        def add(chunks: list) -> dict:
+            nonlocal offset
+            length = sum(len(i) for i in chunks)
+            section = {"offset": offset, "length": length}
+            sections.extend(chunks)
+            padding = -length % 8
+            if padding:
+                sections.append(b"\0" * padding)
+            offset += length + padding
+            return section
+
+        columns = []
+        for name, kind in rows.kinds.items():
+            values = rows.column(name)
+            separated = False
+            if kind == "s":
+                strings = [values[i] for i in range(rows.rows)]
+                separated = not any("\t" in i for i in strings)
+                blobs = [(i + "\t" if separated else i).encode("utf8") for i in strings]
+                offsets = array("Q", [0])
+                for i in blobs:
+                    offsets.append(offsets[-1] + len(i))
+                chunks = [offsets.tobytes(), b"".join(blobs)]
+            elif kind == "pickle":
+                chunks = [pickle.dumps(list(values), pickle.HIGHEST_PROTOCOL)]
+            else:
+                chunks = [bytes(values)]  # array или memoryview другого снимка
+            col = {"name": name, "kind": kind, "separated": separated, "exceptions": None}
+            col.update(add(chunks))
+            exc = rows.exceptions(name)
+            if exc:
+                codes, exc_values = _ExceptionCodes.encode(exc, rows.rows)
+                col['exceptions'] = add([codes.tobytes()])
+                col['exceptions'].update(typecode=codes.typecode, values=exc_values, count=len(exc))
+            columns.append(col)
+        short = add([pickle.dumps(rows._short, pickle.HIGHEST_PROTOCOL)]) if rows._short else None
+        if groups:
+            groups = add([bytes(rows.groups()[1])])
+
+        header = {"report_name": report_name, "rows": rows.rows, "byteorder": sys.byteorder,
+                  "period_begin": period_begin.isoformat() if period_begin else None,
+                  "period_end": period_end.isoformat() if period_end else None,
+                  "columns": columns, "short": short, "groups": groups}
+        encoded = json.dumps(header, ensure_ascii=False).encode("utf8")
+        encoded += b" " * (-len(encoded) % 8)  # секции начинаются с выравниванием по 8 байт
+
+        tmp = f"{path}.part{os.getpid()}"
+        with open(tmp, "wb") as file:
+            file.write(SNAPSHOT_MAGIC)
+            file.write(len(encoded).to_bytes(8, sys.byteorder))
+            file.write(encoded)
+            for i in sections:
+                file.write(i)
+        os.replace(tmp, path)
+
+
 class TSVReport:
-    def __init__(self, tsv: str = "") -> None:
+    parallel_min_rows = 100000  # на отчетах меньшего размера накладные расходы пула процессов не окупаются
+
+    def __init__(self, tsv: str = "", processes: int = None) -> None:
+        """
+        :param tsv: текст отчета в формате TSV
+        :param processes: количество процессов для разбора больших отчетов (None или 1 - в текущем процессе).
+                          Тип self.data зависит только от processes: при processes > 1 - всегда ColumnRows
+                          (строки только для чтения собираются при обращении, меньше памяти на большом отчете),
+                          иначе - список dict. Отчеты меньше parallel_min_rows строк разбираются в текущем
+                          процессе, но тоже в ColumnRows
+        """
         self.__tsv = tsv
+        self.processes = processes
         self.data = []
         self.report_name = ""
         self.period_begin = None
@@ -225,25 +1178,65 @@ class TSVReport:
         self.report_name = report[0].replace("\"", "").split()[0]
         self.period_begin, self.period_end = map(date.fromisoformat, d.search(report[0]).groups())
         fields = report[1].split("\t")
-        for i in report[2:]:
-            line = dict(zip(fields, i.split("\t")))  # получили dict с именами полей
-            # приведение типов для извесных полей
-            for field in ['CampaignId', 'AdGroupId', 'CriteriaId', 'Impressions', 'Clicks', 'Cost']:
-                if line.get(field, False):
-                    if line[field]=="--":
-                        line[field] = "undefined"
-                    else:
-                        line[field] = int(line[field])
-            for field in ['AvgImpressionPosition', 'AvgClickPosition', 'AvgTrafficVolume']:
-                if line.get(field, False):
-                    if line[field].find("-") != -1:
-                        line[field] = None
-                    else:
-                        line[field] = float(line[field])
+        lines = report[2:]
+
+        if self.processes and self.processes > 1 and len(lines) >= self.parallel_min_rows:
+            # разбиваем тело отчета на части по границам строк и приводим типы в пуле процессов,
+            # части возвращаются по колонкам и склеиваются без сборки dict (см. ColumnRows)
+            chunk = -(-len(lines) // (self.processes * 4))
+            parts = (lines[i:i+chunk] for i in range(0, len(lines), chunk))
+            with ProcessPoolExecutor(max_workers=self.processes) as executor:
+                self.data = ColumnRows.from_chunks(executor.map(_convert_tsv_chunk, repeat(fields), parts))
+        elif self.processes and self.processes > 1:
+            # на небольшом отчете пул процессов не окупается, но тип self.data тот же, что и на большом
+            self.data = ColumnRows.from_chunks([_convert_tsv_chunk(fields, lines)])
+        else:
+            self.data.extend(dict(zip(fields, i)) for i in _convert_tsv_lines(fields, lines))
+
+    def _snapshot_rows(self) -> list:
+        return self.data
+
+    def close(self) -> None:
+        """
+        Закрывает снимок, из которого открыт отчет (см. open_snapshot), для остальных отчетов ничего не делает.
+        Отчет можно использовать как контекстный менеджер: with TSVReport.open_snapshot(path) as report: ...
+        """
+        if isinstance(self.data, ReportSnapshot):
+            self.data.close()
 
-            if line.get('Date', False):
-                line['Date'] = date.fromisoformat(line['Date'])
-            self.data.append(line)
+    def __enter__(self) -> TSVReport:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def save_snapshot(self, path: str) -> None:
+        """
+        Сохраняет отчет в бинарный колоночный снимок (см. ReportSnapshot)
+        :param path: путь к файлу снимка
+        """
+        ReportSnapshot.save(path, self._snapshot_rows(), self.report_name, self.period_begin, self.period_end)
+
+    @classmethod
+    def open_snapshot(cls, path: str) -> TSVReport:
+        """
+        Открывает отчет из снимка через mmap. self.data - ReportSnapshot, строки собираются при обращении
+        к ним, колонки доступны через self.data.column(). Строки снимка хранятся сгруппированными по датам
+        и кампаниям, TSVReportByDate использует их диапазоны, не копируя данные снимка.
+        Снимок должен оставаться открытым, пока используется отчет, закрывается через close() или with
+
+        :param path: путь к файлу снимка
+        :return: отчет класса cls
+        """
+        snapshot = ReportSnapshot(path)
+        report = TSVReport()
+        report.data = snapshot
+        report.report_name = snapshot.meta['report_name']
+        report.period_begin, report.period_end = (date.fromisoformat(i) if i else None for i in
+                                                  (snapshot.meta['period_begin'], snapshot.meta['period_end']))
+        if cls is TSVReport:
+            return report
+        return cls(report)
 
     def search_field(self, field_name, field_value):
         if len(self.data) > 0:
@@ -263,16 +1256,25 @@ class TSVReport:
 
 
 class TSVReportByDate(TSVReport):
-    def __init__(self, tsv: str = "") -> None:
+    def __init__(self, tsv: str = "", processes: int = None) -> None:
         if type(tsv) is str:
-            super(TSVReportByDate, self).__init__(tsv)
+            super(TSVReportByDate, self).__init__(tsv, processes)
         elif type(tsv) is TSVReport:
             self.__dict__ = tsv.__dict__
 
         self.ids_index = set()
+        self.index_enabled = False  # после build_index() индекс поддерживается в add_data()/set_begin_date()
+        self.__index_counts = {}  # (CampaignId, AdGroupId, AdGroupName, CriteriaId, Criteria) -> кол-во строк
+        self.keyword_index = {}  # нормализованный текст ключевой фразы -> set кортежей ids_index
+        self.adgroup_index = {}  # AdGroupId -> set кортежей ids_index
+        self.campaign_index = {}  # CampaignId -> set кортежей ids_index
         self.date_data = DateDeque()
+        self.__snapshots = []  # снимки присоединенных отчетов (add_data), закрываются в close()
 
-        if self.data:
+        if isinstance(self.data, ColumnRows):  # снимок или разбор в несколько процессов
+            self.data = self.data.grouped()
+            self._create_date_report_from_columns(self.data)
+        elif self.data:
             self._create_date_report_from_data(self.data)
 
     def __getitem__(self, date_item: date) -> tuple:
@@ -304,7 +1306,7 @@ class TSVReportByDate(TSVReport):
             curr_campaignid = i.pop('CampaignId')
 
             if curr_date != start_point:
-                self.date_data.append((start_point, tmp_date))
+                self.__append_date(start_point, tmp_date)
                 start_point = curr_date
                 tmp_date = dict()
 
@@ -314,27 +1316,151 @@ class TSVReportByDate(TSVReport):
             tmp_date[curr_campaignid].append(i)
 
         if tmp_date:
-            self.date_data.append((start_point, tmp_date))
+            self.__append_date(start_point, tmp_date)
+
+    def _create_date_report_from_columns(self, d: ColumnRows) -> None:
+        """
+        Группирует строки по датам и кампаниям так же, как _create_date_report_from_data, но без сборки dict:
+        для каждой кампании хранится представление ColumnRowsView над диапазоном строк d (см. ColumnRows.grouped).
+        Для ReportSnapshot границы групп читаются из файла, данные остаются в общем page cache
+        """
+        if isinstance(d, ReportSnapshot) and d is not self.data:
+            self.__snapshots.append(d)
+        order, bounds = d.groups()
+        start_point, tmp_date = None, dict()
+        for k in range(len(bounds) - 1):
+            first = order[bounds[k]]
+            curr_date, curr_campaignid = d.value('Date', first), d.value('CampaignId', first)
+            if curr_date != start_point and tmp_date:
+                self.__append_date(start_point, tmp_date)
+                tmp_date = dict()
+            start_point = curr_date
+            tmp_date[curr_campaignid] = d.select(order, ('Date', 'CampaignId'), bounds[k], bounds[k + 1])
+
+        if tmp_date:
+            self.__append_date(start_point, tmp_date)
+
+    @staticmethod
+    def _fields(rows, fields: tuple):
+        """
+        Значения полей fields (кортежи) по строкам одной кампании: для ColumnRowsView - по колонкам,
+        без сборки строк, для списка dict - из строк (отсутствующее поле - None)
+        """
+        if isinstance(rows, ColumnRowsView):
+            return zip(*(rows.values(f) for f in fields))
+        return (tuple(map(k.get, fields)) for k in rows)
+
+    def __append_date(self, curr_date: date, day: dict) -> None:
+        self.date_data.append((curr_date, day))
+        if self.index_enabled:
+            self.__index_date(day, 1)
+
+    @staticmethod
+    def normalize_keyword(criteria: str) -> str:
+        """
+        Приводит текст ключевой фразы к виду для поиска по keyword_index:
+        без минус-слов и операторов, в нижнем регистре, с одиночными пробелами
+        """
+        return " ".join(KEYWORD_OPERATORS.sub(" ", NEGATIVE_KEYWORDS.sub("", criteria)).lower().split())
+
+    def __index_date(self, day: dict, sign: int) -> None:
+        """
+        Добавляет (sign=1) или убирает (sign=-1) строки одной даты из индексов.
+        Для каждого критерия хранится количество строк, поэтому критерий пропадает
+        из индексов только когда удалена последняя дата, в которой он встречался
+        """
+        counts = self.__index_counts
+        for campaign_id, rows in day.items():
+            for adgroup_id, adgroup_name, criteria_id, criteria in \
+                    self._fields(rows, ('AdGroupId', 'AdGroupName', 'CriteriaId', 'Criteria')):
+                out = (campaign_id, adgroup_id, adgroup_name, criteria_id,
+                       NEGATIVE_KEYWORDS.sub("", criteria)  # подчищаем минус слова
+                       )
+                count = counts.get(out, 0) + sign
+                if count > 0:
+                    counts[out] = count
+                    if count == 1 and sign > 0:
+                        self.__index_add(out)
+                else:
+                    counts.pop(out, None)
+                    self.__index_remove(out)
+
+    def __index_add(self, out: tuple) -> None:
+        self.ids_index.add(out)
+        self.keyword_index.setdefault(self.normalize_keyword(out[4]), set()).add(out)
+        self.adgroup_index.setdefault(out[1], set()).add(out)
+        self.campaign_index.setdefault(out[0], set()).add(out)
+
+    def __index_remove(self, out: tuple) -> None:
+        self.ids_index.discard(out)
+        for index, key in ((self.keyword_index, self.normalize_keyword(out[4])),
+                           (self.adgroup_index, out[1]),
+                           (self.campaign_index, out[0])):
+            items = index.get(key)
+            if items is not None:
+                items.discard(out)
+                if not items:
+                    del index[key]
+
+    def _snapshot_rows(self) -> list:
+        # строки self.data после группировки по датам не содержат Date и CampaignId
+        return list(self)
+
+    def close(self) -> None:
+        """
+        Закрывает снимок отчета и снимки присоединенных через add_data() отчетов
+        """
+        super(TSVReportByDate, self).close()
+        for snapshot in self.__snapshots:
+            snapshot.close()
+        self.__snapshots = []
 
     def build_index(self) -> None:
         """
         создает индекс по идентификаторам (CampaignId, AdGroupId, AdGroupName, CriteriaId, Criteria)
+        и обратные индексы keyword_index, adgroup_index, campaign_index.
+        После первого вызова индекс поддерживается инкрементально при add_data() и set_begin_date(),
+        повторные вызовы ничего не делают
         :return:
         """
+        if self.index_enabled:
+            return None
+        self.index_enabled = True
         for d in self.date_data:
-            for j in d[1].items():  # d[0] - дата
-                for k in j[1]:  # j[0] - CampaignId
-                    out = (j[0], k['AdGroupId'], k['AdGroupName'], k['CriteriaId'],
-                           re.sub("\s\-.*$", "", k['Criteria'])  # подчищаем минус слова
-                           )
+            self.__index_date(d[1], 1)  # d[0] - дата
+
+    def search_keyword(self, criteria: str) -> frozenset:
+        """
+        :param criteria: текст ключевой фразы (нормализуется, см. normalize_keyword)
+        :return: frozenset кортежей (CampaignId, AdGroupId, AdGroupName, CriteriaId, Criteria),
+                 копия, чтобы изменения результата не портили индекс
+        """
+        self.build_index()
+        return frozenset(self.keyword_index.get(self.normalize_keyword(criteria), ()))
+
+    def search_adgroup(self, adgroup_id: int) -> frozenset:
+        self.build_index()
+        return frozenset(self.adgroup_index.get(int(adgroup_id), ()))
 
-                    self.ids_index.add(out)
+    def search_campaign(self, campaign_id: int) -> frozenset:
+        self.build_index()
+        return frozenset(self.campaign_index.get(int(campaign_id), ()))
 
     def set_begin_date(self, begin_date: date) -> None:
         self.period_begin = begin_date
+        if self.index_enabled:
+            for d in self.date_data:
+                if d[0] < begin_date:
+                    self.__index_date(d[1], -1)
         self.date_data.clear_dates_before(begin_date)
 
     def add_data(self, d: TSVReport) -> None:
+        """
+        Присоединяет статистику следующего периода. Строки отчета из снимка не копируются: снимок
+        присоединенного отчета закрывается вместе с этим отчетом (close()), отдельно его закрывать нельзя
+
+        :param d: отчет, период которого начинается на следующий день после self.period_end
+        """
         if self.report_name and self.report_name != d.report_name:
             logger.error(f"Тип присоединяемого отчета {d.report_name} не совпадает с {self.report_name}")
             raise IntegrityDataError
@@ -345,7 +1471,10 @@ class TSVReportByDate(TSVReport):
             raise PeriodError
 
         self.period_end = d.period_end
-        self._create_date_report_from_data(d.data)
+        if isinstance(d.data, ColumnRows):  # снимок или разбор в несколько процессов
+            self._create_date_report_from_columns(d.data.grouped())
+        else:
+            self._create_date_report_from_data(d.data)
 
     def summ_stat(self, from_date: date = False, to_date: date = False,
                   campaign_id: int = False, adgroup_id: int = False, criteria_id: int = False) -> dict:
@@ -378,19 +1507,62 @@ class TSVReportByDate(TSVReport):
                   "CampaignId": campaign_id, "AdGroupId": adgroup_id, "CriteriaId": criteria_id,
                   "Impressions": 0, "Clicks": 0, "Cost": 0}
 
+        fields = ('AdGroupId', 'CriteriaId', 'Impressions', 'Clicks', 'Cost')
         for i in self.date_data:
             if i[0] in period:
                 for j in i[1].items():
                     if not campaign_id or campaign_id == j[0]:
-                        for k in j[1]:
-                            if not adgroup_id or adgroup_id == k['AdGroupId']:
-                                if not criteria_id or criteria_id == k['CriteriaId']:
-                                    result['Impressions'] += k['Impressions']
-                                    result['Clicks'] += k['Clicks']
-                                    result['Cost'] += k['Cost']
+                        for k_adgroup, k_criteria, impressions, clicks, cost in self._fields(j[1], fields):
+                            if not adgroup_id or adgroup_id == k_adgroup:
+                                if not criteria_id or criteria_id == k_criteria:
+                                    result['Impressions'] += impressions
+                                    result['Clicks'] += clicks
+                                    result['Cost'] += cost
 
         return result
 
+    def criteria_stat(self, from_date: date = False, to_date: date = False) -> dict:
+        """
+        Подсчитывает статистику сразу по всем критериям за один проход по отчету
+        (вместо вызова summ_stat для каждого критерия).
+        Conversions учитываются, если поле есть в отчете, AvgImpressionPosition усредняется с весом Impressions
+
+        :param from_date: дата в формате YYYY-MM-DD или class 'datetime.date'
+        :param to_date: дата в формате YYYY-MM-DD или class 'datetime.date'
+        :return: dict CriteriaId -> {"CampaignId", "AdGroupId", "Impressions", "Clicks", "Cost",
+                 "Conversions", "AvgImpressionPosition"}
+        """
+        from_date = date.fromisoformat(from_date) if type(from_date) is str else from_date
+        to_date = date.fromisoformat(to_date) if type(to_date) is str else to_date
+
+        result = {}
+        positions = {}  # CriteriaId -> сумма AvgImpressionPosition * Impressions, показы с известной позицией
+        fields = ('CriteriaId', 'AdGroupId', 'Impressions', 'Clicks', 'Cost', 'Conversions', 'AvgImpressionPosition')
+        for i in self.date_data:
+            if (from_date and i[0] < from_date) or (to_date and i[0] > to_date):
+                continue
+            for campaign_id, rows in i[1].items():
+                for criteria_id, adgroup_id, impressions, clicks, cost, conversions, position in \
+                        self._fields(rows, fields):
+                    item = result.get(criteria_id)
+                    if item is None:
+                        item = result[criteria_id] = {"CampaignId": campaign_id, "AdGroupId": adgroup_id,
+                                                      "Impressions": 0, "Clicks": 0, "Cost": 0,
+                                                      "Conversions": 0, "AvgImpressionPosition": None}
+                    item['Impressions'] += impressions
+                    item['Clicks'] += clicks
+                    item['Cost'] += cost
+                    if conversions not in ("--", "", None):  # None - поля нет в отчете
+                        item['Conversions'] += int(conversions)
+                    if type(position) is float and impressions:  # "" и "-" остаются строками
+                        acc = positions.setdefault(criteria_id, [0.0, 0])
+                        acc[0] += position * impressions
+                        acc[1] += impressions
+
+        for criteria_id, acc in positions.items():
+            result[criteria_id]['AvgImpressionPosition'] = acc[0] / acc[1]
+        return result
+
 
 class YandexDirectBase:
     service = {
@@ -407,12 +1579,17 @@ class YandexDirectBase:
         'AdExtensions': "https://api.direct.yandex.com/json/v5/adextensions",
         'v4live': "https://api.direct.yandex.ru/live/v4/json/",
     }
+    # https://yandex.ru/dev/direct/doc/dg/concepts/errors.html
+    # 52 - сервер авторизации временно недоступен, 506 - превышено ограничение одновременных запросов,
+    # 1000 - сервис временно недоступен
+    temporary_error_codes = (52, 506, 1000)
 
     def __init__(self, directory="./", dump_file_prefix="fooooo", cache=True, account="default", login="default"):
         self.selected_account_name = account if login=="default" else login
-        self.headers = {"Authorization": "Bearer " + ENVI['PYSEA_YD_TOKEN'], "Accept-Language": "ru",}
+        self.token = ENVI['PYSEA_YD_TOKEN']
         if account != "default":
-            self.headers = {"Authorization": "Bearer " + ENVI[f'PYSEA_YD_{account.upper()}_TOKEN'], "Accept-Language": "ru", }
+            self.token = ENVI[f'PYSEA_YD_{account.upper()}_TOKEN']
+        self.headers = {"Authorization": "Bearer " + self.token, "Accept-Language": "ru", }
         if login != "default":
             self.headers.update({"Client-Login": login})
         # переменные настраивающие кеширование запросов к API
@@ -424,6 +1601,13 @@ class YandexDirectBase:
         self.limit_by = 200
         self.offset = 0
 
+        # сессия переиспользует соединения между запросами к API v4live
+        self.session = requests.Session()
+        self.timeout = 300
+
+        # повторные попытки, ограничения времени и размыкание цепи для всех запросов к API
+        self.retry_policy = RetryPolicy()
+
     def cache_enabled(self):
         self.cache = True
 
@@ -431,7 +1615,8 @@ class YandexDirectBase:
         self.cache = False
 
     def select_account(self, account_name, login="default"):
-        self.headers = {"Authorization": "Bearer " + ENVI[f'PYSEA_YD_{account_name.upper()}_TOKEN'], "Accept-Language": "ru", }
+        self.token = ENVI[f'PYSEA_YD_{account_name.upper()}_TOKEN']
+        self.headers = {"Authorization": "Bearer " + self.token, "Accept-Language": "ru", }
         if login != "default":
             self.headers.update({"Client-Login": login})
         self.selected_account_name = account_name if login=="default" else login
@@ -439,15 +1624,20 @@ class YandexDirectBase:
 
         return self
 
-    def send_request(self, body, srv_type):
+    def send_request(self, body, srv_type, strict=True):
         """
         Выполняет непосредственно запрос к серверу API
         Принимает на входе сформированное тело запроса и тип запроса
 
         :param body: тело запроса к API Яндекс Директ
         :param srv_type: тип запроса (метка URL запроса, описана в YandexDirectBase.service)
+        :param strict: False - ошибки отдельных объектов в ответе на изменяющий метод только логируются,
+                       их разбирает вызывающий код
         :return: возврящает полный ответ сервера
         """
+        return self.retry_policy.call(self.__send_request, body, srv_type, strict, service=srv_type)
+
+    def __send_request(self, body, srv_type, strict=True):
         mutate_method = f"{body['method'].capitalize()}Results"
         if body['method'] == "get":
             mutate_method = ""
@@ -460,21 +1650,21 @@ class YandexDirectBase:
 
         # Выполнение запроса
         try:
-            result = requests.post(self.service[srv_type], json_body, headers=self.headers)
+            result = requests.post(self.service[srv_type], json_body, headers=self.headers, timeout=self.timeout)
             # Распечатывает отладочную информацию
             self.print_request_info(result)
 
             # Обработка запроса
             # https://tech.yandex.ru/direct/doc/dg/concepts/errors-docpage/
+            self.check_server_response(result)
             if result.status_code != 200 or result.json().get("error", False):
                 logger.error(f"Произошла ошибка при обращении к серверу API Директа.\n"
                              f"Код ошибки: {result.json()['error']['error_code']}\n"
                              f"Ошибка: {result.json()['error']['error_string']}\n"
                              f"Описание ошибки: {result.json()['error']['error_detail']}\n"
                              f"RequestId: {result.headers.get('RequestId', False)}")
-                if result.json()['error']['error_code'] == 1000 and \
-                        result.json()['error']['error_string'] == "Сервис временно недоступен":
-                    raise InternalYDServerError
+                if result.json()['error']['error_code'] in self.temporary_error_codes:
+                    raise self.internal_error(result)
                 else:
                     raise YandexDirectError
             else:
@@ -486,6 +1676,8 @@ class YandexDirectBase:
                 for mutate_result in result.json()['result'][mutate_method]:
                     if mutate_result.get('Errors', False):
                         logger.error(mutate_result)
+                        if not strict:
+                            continue
                         if mutate_method == 'DeleteResults':
                             if mutate_result['Errors'][0]['Code'] == 6000 and \
                                     mutate_result['Errors'][0]['Details'] == \
@@ -507,81 +1699,129 @@ class YandexDirectBase:
                 else:
                     logger.info(f"Кол-во записей в ответе: {len(result.json()['result'].get(srv_type, ()))}")
 
-        except ConnectionError:
+        except (ConnectionError, requests.exceptions.ConnectionError, requests.exceptions.Timeout):
             logger.error("ConnectionError во время обращения к Яндекс API")
             raise ConnectionError
 
+        except (YandexDirectError, requests.exceptions.ChunkedEncodingError, ProtocolError):
+            raise
+
         except Exception as ex:
             logger.error(f"Произошла непредвиденная ошибка во время обращения к Яндекс API (в send_request()) {ex}")
             raise YandexDirectError
 
         return result
 
-    def send_request_report(self, body):
+    def send_request_report(self, body, processes=None):
         """
         Выполняет непосредственно запрос к серверу API. Функция заточена для Report запросов.
         https://tech.yandex.ru/direct/doc/examples-v5/python3_requests_stat1-docpage/
         Реализует проверку готовности отчета
         https://tech.yandex.ru/direct/doc/reports/mode-docpage/
 
+        При self.cache отчет сохраняется в снимок (см. ReportSnapshot) и при повторном запросе в тот же день
+        читается из него. Тип отчета не зависит от того, был ли снимок: при processes > 1 self.data - ColumnRows
+        (из кеша - ReportSnapshot над mmap, отчет нужно закрыть через close() или with),
+        иначе - список dict (снимок читается целиком и сразу закрывается)
+
         :param body: тело запроса к API Яндекс Директ
+        :param processes: количество процессов для разбора большого отчета (см. TSVReport)
         :return: возврящает отчет TSVReport
         """
+        # снимок отчета кешируется по хешу тела запроса и текущей дате
+        # (как в dump_to, иначе отчеты с относительным DateRangeType (TODAY, LAST_7_DAYS, ...) устаревают)
+        key = hashlib.sha1(json.dumps(body, sort_keys=True, ensure_ascii=False).encode('utf8')).hexdigest()
+        file_out = f"{self.directory}/{self.dump_file_prefix}_report_{key}_{date.today()}.snapshot".replace("//", "/")
+        if self.cache and os.path.isfile(file_out):
+            try:
+                report = TSVReport.open_snapshot(file_out)
+            except Exception as err:
+                logger.debug(f"{err}\n Snapshot file {file_out} is broken, getting fresh...")
+            else:
+                if not (processes and processes > 1):  # как и без кеша - список dict
+                    snapshot = report.data
+                    report.data = [snapshot.row(i) for i in range(len(snapshot))]
+                    snapshot.close()
+                return report
 
         # Кодирование тела запроса в JSON
         body = json.dumps(body, indent=4)
+        policy = self.retry_policy
+        report_deadline = monotonic() + policy.deadline if policy.deadline is not None else None
 
         # --- Запуск цикла для выполнения запросов ---
         # Если получен HTTP-код 200, то выводится содержание отчета
         # Если получен HTTP-код 201 или 202, выполняются повторные запросы
         while True:
+            result = policy.call(self.__send_request_report, body, service='Reports')
+            if result.status_code == 200:
+                break
+
+            retry_in = int(result.headers.get("retryIn", 60))
+            if result.status_code == 201:
+                logger.info(f"Отчет успешно поставлен в очередь в режиме офлайн\n"
+                            f"Повторная отправка запроса через {retry_in} секунд")
+            else:
+                logger.info(f"Отчет формируется в режиме офлайн\n"
+                            f"Повторная отправка запроса через {retry_in} секунд")
+            policy.sleep(retry_in, report_deadline)
+
+        report = TSVReport(result.text, processes)
+        if self.cache:
             try:
-                result = requests.post(self.service['Reports'], body, headers=self.headers)
-                # Распечатывает отладочную информацию
-                self.print_request_info(result)
-
-                result.encoding = 'utf-8'  # Принудительная обработка ответа в кодировке UTF-8
-                if result.status_code == 400:
-                    logger.error(f"{result.status_code} Параметры запроса указаны неверно "
-                                 f"или достигнут лимит отчетов в очереди")
-                    raise YandexDirectError
-                elif result.status_code == 200:
-                    logger.info("Отчет создан успешно.")
-                    # logger.debug(f"Содержание отчета: \n{result.text}")
-                    break
-                elif result.status_code == 201:
-                    retry_in = int(result.headers.get("retryIn", 60))
-                    logger.info(f"Отчет успешно поставлен в очередь в режиме офлайн\n"
-                                f"Повторная отправка запроса через {retry_in} секунд")
-                    sleep(retry_in)
-                elif result.status_code == 202:
-                    retry_in = int(result.headers.get("retryIn", 60))
-                    logger.info(f"Отчет формируется в режиме офлайн\n"
-                                f"Повторная отправка запроса через {retry_in} секунд")
-                    sleep(retry_in)
-                elif result.status_code == 500:
-                    logger.error("При формировании отчета произошла ошибка. Попробуйте повторить запрос позднее")
-                    raise InternalYDServerError
-                elif result.status_code == 502:
-                    logger.error(f"Время формирования отчета превысило серверное ограничение.\n"
-                                 f"Пожалуйста, попробуйте уменьшить период и количество запрашиваемых данных.")
-                    raise YandexDirectError
-                else:
-                    logger.error(f"Произошла непредвиденная ошибка во время обращения "
-                                 f"к Яндекс API (в send_request_report())")
-                    raise YandexDirectError
+                report.save_snapshot(file_out)
+            except Exception as err:  # не теряем уже полученный отчет из-за ошибки записи кеша
+                logger.error(f"Не удалось записать снимок отчета {file_out}: {err}")
+        return report
 
-            # Обработка ошибки, если не удалось соединиться с сервером API Директа
-            except ConnectionError:
-                # повторить запрос позднее
-                raise ConnectionError
+    def __send_request_report(self, body):
+        """
+        Один запрос к сервису Reports
+        :return: ответ сервера с HTTP-кодом 200, 201 или 202
+        """
+        try:
+            result = requests.post(self.service['Reports'], body, headers=self.headers, timeout=self.timeout)
+            # Распечатывает отладочную информацию
+            self.print_request_info(result)
 
-            # Если возникла какая-либо другая ошибка
-            except Exception as ex:
-                logger.error(f"Произошла непредвиденная ошибка во время обращения к Яндекс API (в send_request()) {ex}")
+            result.encoding = 'utf-8'  # Принудительная обработка ответа в кодировке UTF-8
+            if result.status_code == 400:
+                logger.error(f"{result.status_code} Параметры запроса указаны неверно "
+                             f"или достигнут лимит отчетов в очереди")
                 raise YandexDirectError
+            elif result.status_code == 200:
+                logger.info("Отчет создан успешно.")
+                # logger.debug(f"Содержание отчета: \n{result.text}")
+            elif result.status_code in (201, 202):
+                pass
+            elif result.status_code == 500:
+                logger.error("При формировании отчета произошла ошибка. Попробуйте повторить запрос позднее")
+                raise self.internal_error(result)
+            elif result.status_code == 502:
+                logger.error(f"Время формирования отчета превысило серверное ограничение.\n"
+                             f"Пожалуйста, попробуйте уменьшить период и количество запрашиваемых данных.")
+                raise YandexDirectError
+            elif result.status_code > 500:
+                self.check_server_response(result)
+            else:
+                logger.error(f"Произошла непредвиденная ошибка во время обращения "
+                             f"к Яндекс API (в send_request_report())")
+                raise YandexDirectError
+
+        # Обработка ошибки, если не удалось соединиться с сервером API Директа
+        except (ConnectionError, requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            # повторить запрос позднее
+            raise ConnectionError
+
+        except (YandexDirectError, requests.exceptions.ChunkedEncodingError, ProtocolError):
+            raise
+
+        # Если возникла какая-либо другая ошибка
+        except Exception as ex:
+            logger.error(f"Произошла непредвиденная ошибка во время обращения к Яндекс API (в send_request()) {ex}")
+            raise YandexDirectError
 
-        return TSVReport(result.text)
+        return result
 
     def send_request_v4(self, body):
         """
@@ -592,9 +1832,11 @@ class YandexDirectBase:
         :param body: тело запроса к API Яндекс Директ
         :return: возврящает полный ответ сервера
         """
+        return self.retry_policy.call(self.__send_request_v4, body, service='v4live')
 
+    def __send_request_v4(self, body):
         body.update({
-            'token': ENVI['PYSEA_YD_TOKEN'],
+            'token': self.token,  # токен выбранного аккаунта, а не аккаунта по умолчанию
             'locale': 'ru'
         })
 
@@ -603,23 +1845,60 @@ class YandexDirectBase:
 
         # Выполнение запроса
         try:
-            response = urlopen(self.service['v4live'], json_body)
-            response = json.loads(response.read().decode('utf8'))
+            response = self.session.post(self.service['v4live'], json_body, timeout=self.timeout)
+            response.encoding = 'utf-8'
+            self.check_server_response(response)
+            response = response.json()
 
             if response.get("error_code", False):
                 logger.error(f"Произошла ошибка при обращении к серверу API Директа.\n {response}")
+                if response['error_code'] in self.temporary_error_codes:
+                    raise InternalYDServerError
                 raise YandexDirectError
 
-        except ConnectionError:
-            # повторить запрос позднее
+        except (ConnectionError, requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            # повторить запрос позднее (см. RetryPolicy)
+            logger.error("ConnectionError во время обращения к Яндекс API v4live")
             raise ConnectionError
 
+        except (YandexDirectError, requests.exceptions.ChunkedEncodingError, ProtocolError):
+            raise
+
         except Exception as ex:
             logger.error(f"Произошла непредвиденная ошибка (в send_request_v4()), {ex}")
             raise YandexDirectError
 
         return response
 
+    @classmethod
+    def check_server_response(cls, result):
+        """
+        Ответы 5xx и ответы, которые не разбираются как JSON (HTML страница балансировщика, обрезанный ответ),
+        говорят о недоступности сервиса, а не об ошибке запроса - выбрасывается InternalYDServerError,
+        чтобы запрос был повторен и неудача учтена в CircuitBreaker (см. RetryPolicy)
+        """
+        if result.status_code >= 500:
+            logger.error(f"Сервер API Директа недоступен, HTTP-код {result.status_code}\n"
+                         f"RequestId: {result.headers.get('RequestId', False)}")
+            raise cls.internal_error(result)
+        try:
+            result.json()
+        except ValueError:
+            logger.error(f"Ответ сервера API Директа не является JSON, HTTP-код {result.status_code}\n"
+                         f"RequestId: {result.headers.get('RequestId', False)}")
+            raise cls.internal_error(result)
+
+    @staticmethod
+    def internal_error(result):
+        """
+        Создает InternalYDServerError с подсказкой сервера о паузе перед повтором (если она есть в заголовках)
+        """
+        err = InternalYDServerError()
+        retry_in = result.headers.get("retryIn", result.headers.get("Retry-After", None))
+        if retry_in is not None and str(retry_in).isdigit():
+            err.retry_in = int(retry_in)
+        return err
+
     @staticmethod
     def print_request_info(result):
         """
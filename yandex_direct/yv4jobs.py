@@ -0,0 +1,222 @@
+from common_constants import constants
+from yandex_direct import ydbase
+import json
+from datetime import date
+import pickle
+import os
+ENVI = constants.EnviVar(
+    main_dir="/home/eugene/Yandex.Disk/localsource/yandex_direct/",
+    cred_dir="/home/eugene/Yandex.Disk/localsource/credentials/"
+)
+logger = constants.logging.getLogger(__name__)
+
+
+class YV4Jobs(ydbase.YandexDirectBase):
+    """
+    Менеджер асинхронных отчетов API v4 Live (Wordstat и прогноз бюджета):
+    создание отчета -> опрос готовности -> получение -> удаление.
+    https://yandex.ru/dev/direct/doc/dg-v4/live/CreateNewWordstatReport-docpage/
+    https://yandex.ru/dev/direct/doc/dg-v4/live/CreateNewForecast-docpage/
+
+    На сервере одновременно может храниться ограниченное число отчетов (slots),
+    менеджер держит в работе столько отчетов, сколько позволяет лимит, опрашивает
+    их все одним запросом *List и сразу освобождает место после получения результата.
+    Результаты кешируются по набору фраз, регионам и дополнительным параметрам отчета.
+    """
+    kinds = {
+        'wordstat': {'create': 'CreateNewWordstatReport', 'list': 'GetWordstatReportList',
+                     'get': 'GetWordstatReport', 'delete': 'DeleteWordstatReport',
+                     'id': 'ReportID', 'status': 'StatusReport', 'slots': 5, 'phrases': 10},
+        'forecast': {'create': 'CreateNewForecast', 'list': 'GetForecastList',
+                     'get': 'GetForecast', 'delete': 'DeleteForecast',
+                     'id': 'ForecastID', 'status': 'StatusForecast', 'slots': 5, 'phrases': 100},
+    }
+
+    def __init__(self, kind="wordstat", directory=None, dump_file_prefix="yv4jobs", cache=False,
+                 account="default", login="default", poll_interval=10):
+        if directory is None:
+            directory = f"{ENVI['MAIN_PYSEA_DIR']}alldata/cache"
+        super(YV4Jobs, self).__init__(directory=directory, dump_file_prefix=dump_file_prefix, cache=cache, account=account, login=login)
+        if kind not in self.kinds:
+            raise KeyError(kind)
+        self.kind = kind
+        self.methods = self.kinds[kind]
+        self.poll_interval = poll_interval
+
+        self.queue = []  # ключи (phrases, geo, params) ожидающие создания отчета
+        self.params = {}  # ключ -> параметры CreateNew*
+        self.in_flight = {}  # идентификатор отчета на сервере -> ключ
+        self.results = self.__load_cache()
+        self.failed = []
+
+    def __str__(self):
+        return f"<<Отчеты v4 Live {self.kind}: в очереди {len(self.queue)}, в работе {len(self.in_flight)}, " \
+               f"готово {len(self.results)}>>"
+
+    def __len__(self):
+        return len(self.results)
+
+    def __getitem__(self, key):
+        return self.results[key]
+
+    @property
+    def file_out(self):
+        return "{}/{}_{}_{}.pickle".format(self.directory, self.dump_file_prefix, self.kind,
+                                           date.today()).replace("//", "/")
+
+    def __load_cache(self):
+        if self.cache:
+            try:
+                with open(self.file_out, "rb") as file:
+                    return pickle.load(file)
+            except Exception as err:
+                logger.debug(f"{err}\n Cache file {self.file_out} is empty, getting fresh...")
+        return {}
+
+    def __dump_cache(self):
+        file_part = f"{self.file_out}.part"
+        try:
+            with open(file_part, "wb") as file:
+                pickle.dump(self.results, file, pickle.HIGHEST_PROTOCOL)
+            os.replace(file_part, self.file_out)
+        except Exception as err:  # не теряем уже полученные результаты из-за ошибки записи кеша
+            logger.error(f"Не удалось записать кеш {self.file_out}: {err}")
+
+    @staticmethod
+    def make_key(phrases, geo_ids=(), **params):
+        """
+        Ключ кеша: набор фраз (без учета порядка и регистра), набор регионов
+        и дополнительные параметры отчета (Currency, AuctionBids и т.п. меняют результат)
+
+        :param phrases: список фраз
+        :param geo_ids: список идентификаторов регионов
+        :param params: дополнительные параметры метода CreateNew*
+        :return: tuple
+        """
+        if type(phrases) is str:
+            phrases = [phrases]
+        if type(geo_ids) is int:
+            geo_ids = [geo_ids]
+        params = tuple(sorted((k, json.dumps(v, sort_keys=True, ensure_ascii=False)) for k, v in params.items()))
+        return tuple(sorted({i.strip().lower() for i in phrases})), tuple(sorted(set(geo_ids))), params
+
+    def add(self, phrases, geo_ids=(), **params):
+        """
+        Ставит отчет в очередь. Отчеты с уже полученным (или поставленным в очередь) ключом повторно не создаются
+
+        :param phrases: список фраз (не более 10 для wordstat, 100 для forecast)
+        :param geo_ids: список идентификаторов регионов
+        :param params: дополнительные параметры метода CreateNew* (например Currency для прогноза)
+        :return: ключ, по которому доступен результат
+        """
+        key = self.make_key(phrases, geo_ids, **params)
+        if len(key[0]) > self.methods['phrases']:
+            logger.error(f"Превышено количество фраз в одном отчете {self.kind}: {len(key[0])}")
+            raise ydbase.YandexDirectError
+        if key in self.results or key in self.params:
+            return key
+
+        param = {"Phrases": list(key[0])}
+        if key[1]:
+            param["GeoID"] = list(key[1])
+        param.update(params)
+        self.params[key] = param
+        self.queue.append(key)
+        return key
+
+    def __call(self, method, param=None):
+        body = {"method": method}
+        if param is not None:
+            body["param"] = param
+        return self.send_request_v4(body)['data']
+
+    def run(self):
+        """
+        Выполняет все отчеты из очереди, пока очередь не опустеет и все отчеты не будут получены
+
+        Ограничение времени задается через self.retry_policy.job(seconds), по его истечении
+        выбрасывается DeadlineExceededError. При любом прерывании отчеты этого менеджера удаляются
+        с сервера, чтобы не занимать места, и возвращаются в очередь.
+        Кеш результатов записывается один раз по завершении (в том числе при прерывании).
+
+        :return: dict ключ -> результат отчета
+        """
+        collected = len(self.results)
+        try:
+            while self.queue or self.in_flight:
+                stored = self.__call(self.methods['list'])
+                released = self.__collect(stored)
+
+                free_slots = self.methods['slots'] - len(stored) + released
+                while self.queue and free_slots > 0:
+                    key = self.queue.pop(0)
+                    report_id = self.__call(self.methods['create'], self.params[key])
+                    self.in_flight[report_id] = key
+                    free_slots -= 1
+                    logger.info(f"Создан отчет {self.kind} {report_id} для {key}")
+
+                if self.queue or self.in_flight:  # ждем готовности отчетов или освобождения мест на сервере
+                    self.retry_policy.sleep(self.poll_interval)
+        except BaseException:
+            self.__release_in_flight()
+            raise
+        finally:
+            if len(self.results) != collected:
+                self.__dump_cache()
+
+        return self.results
+
+    def __release_in_flight(self):
+        """
+        Удаляет с сервера отчеты, созданные менеджером, и возвращает их ключи в начало очереди
+        """
+        for report_id, key in list(self.in_flight.items()):
+            try:
+                self.__call(self.methods['delete'], report_id)
+            except Exception as err:
+                logger.error(f"Не удалось удалить отчет {self.kind} {report_id}: {err}")
+            del self.in_flight[report_id]
+            self.queue.insert(0, key)
+
+    def __collect(self, stored):
+        """
+        Забирает готовые отчеты и удаляет их с сервера, освобождая место под новые.
+        Отчет снимается с учета (in_flight) только после успешного получения и удаления,
+        иначе при ошибке он остается на сервере и удаляется в __release_in_flight
+
+        :param stored: ответ метода Get*List
+        :return: количество освобожденных мест на сервере
+        """
+        released = 0
+        for item in stored:
+            report_id = item[self.methods['id']]
+            if report_id not in self.in_flight:
+                continue  # отчет создан не этим менеджером
+
+            status = item[self.methods['status']]
+            if status == "Pending":
+                continue
+
+            key = self.in_flight[report_id]
+            result = self.__call(self.methods['get'], report_id) if status == "Done" else None
+            self.__call(self.methods['delete'], report_id)
+            del self.in_flight[report_id]
+            released += 1
+
+            if status == "Done":
+                self.results[key] = result
+                logger.info(f"Получен отчет {self.kind} {report_id} для {key}")
+            else:
+                logger.error(f"Отчет {self.kind} {report_id} для {key} завершился со статусом {status}")
+                self.failed.append(key)
+            self.params.pop(key, None)
+
+        # отчеты, пропавшие с сервера (удалены извне), считаем неудачными, чтобы не ждать их бесконечно
+        stored_ids = {i[self.methods['id']] for i in stored}
+        for report_id in [i for i in self.in_flight if i not in stored_ids]:
+            key = self.in_flight.pop(report_id)
+            logger.error(f"Отчет {self.kind} {report_id} для {key} отсутствует на сервере")
+            self.failed.append(key)
+            self.params.pop(key, None)
+
+        return released